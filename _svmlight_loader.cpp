@@ -9,262 +9,1247 @@
  * by many other libraries, including libsvm.
  *
  * The function loads the file directly in a CSR sparse matrix without memory
- * copying.  The approach taken is to use 4 C++ vectors (data, indices, indptr
- * and labels) and to incrementally feed them with elements. Ndarrays are then
- * instantiated by PyArray_SimpleNewFromData, i.e., no memory is
- * copied.
+ * copying. Files that can be mapped into memory are parsed twice: once to
+ * count rows and nonzeros, then again to write them straight into ndarrays
+ * allocated at their final size.
+ *
+ * Files that must be read in chunks instead are counted and parsed a chunk at
+ * a time into 4 malloc'd arrays (data, indices, indptr and labels), which are
+ * grown by exactly the size of each chunk. Ndarrays are then instantiated
+ * by PyArray_SimpleNewFromData, i.e., no memory is copied.
  *
  * Since the memory is not allocated by the ndarray, the ndarray doesn't own the
  * memory and thus cannot deallocate it. To automatically deallocate memory, the
  * technique described at http://blog.enthought.com/?p=62 is used. The main idea
  * is to use an additional object that the ndarray does own and that will be
- * responsible for deallocating the memory.
+ * responsible for deallocating the memory; here, a capsule.
  */
 
 
 #include <Python.h>
 #include <numpy/arrayobject.h>
 
-#include <fstream>
-#include <sstream>
+#if defined(__AVX2__)
+#include <immintrin.h>
+#elif defined(__SSE2__)
+#include <emmintrin.h>
+#endif
+
+#include <algorithm>
+#include <cerrno>
+#include <charconv>
+#include <climits>
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <exception>
+#include <ios>
 #include <stdexcept>
 #include <string>
+#include <system_error>
 #include <vector>
 
+// The writer formats floating point numbers with std::to_chars, which older
+// standard libraries only provide for integers.
+#if defined(_GLIBCXX_RELEASE) && _GLIBCXX_RELEASE < 11
+#error "floating point std::to_chars needs libstdc++ from GCC 11 or later"
+#endif
+#if defined(_LIBCPP_VERSION) && _LIBCPP_VERSION < 14000
+#error "floating point std::to_chars needs libc++ 14 or later"
+#endif
+
+#if defined(__unix__) || defined(__APPLE__)
+#define HAVE_MMAP 1
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
+
+#if defined(__linux__) && defined(__has_include)
+#if __has_include(<linux/io_uring.h>)
+#include <linux/io_uring.h>
+#include <sys/syscall.h>
+#ifdef IORING_FEAT_RW_CUR_POS
+#define HAVE_IO_URING 1
+#endif
+#endif
+#endif
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#include "fast_float.h"
+
 
 /*
- * A Python object responsible for memory management of our vectors.
+ * NumPy type number of the C type used for the data array.
+ */
+template <typename T> struct npy_typenum;
+template <> struct npy_typenum<float>  { enum { value = NPY_FLOAT }; };
+template <> struct npy_typenum<double> { enum { value = NPY_DOUBLE }; };
+
+
+/*
+ * Parsing.
+ */
+
+class SyntaxError : public std::runtime_error {
+public:
+  SyntaxError(std::string const &msg)
+   : std::runtime_error(msg + " in SVMlight/libSVM file")
+  {
+  }
+};
+
+/*
+ * Return a pointer to the first occurrence of c1 or c2 in [p, end), or end.
+ *
+ * This is the structural scan of the tokenizer: a whole vector register of
+ * bytes is compared against both delimiters at once, the comparison results
+ * are folded into a bitmap with movemask, and the first set bit gives the
+ * position of the delimiter. Falls back to a scalar loop for the tail and on
+ * platforms without SSE2.
+ */
+static inline const char *find_either(const char *p, const char *end,
+                                      char c1, char c2)
+{
+#if defined(__AVX2__)
+  const __m256i v1 = _mm256_set1_epi8(c1), v2 = _mm256_set1_epi8(c2);
+  for (; end - p >= 32; p += 32) {
+    __m256i b = _mm256_loadu_si256(reinterpret_cast<const __m256i *>(p));
+    unsigned mask = _mm256_movemask_epi8(
+      _mm256_or_si256(_mm256_cmpeq_epi8(b, v1), _mm256_cmpeq_epi8(b, v2)));
+    if (mask)
+      return p + __builtin_ctz(mask);
+  }
+#elif defined(__SSE2__)
+  const __m128i v1 = _mm_set1_epi8(c1), v2 = _mm_set1_epi8(c2);
+  for (; end - p >= 16; p += 16) {
+    __m128i b = _mm_loadu_si128(reinterpret_cast<const __m128i *>(p));
+    unsigned mask = _mm_movemask_epi8(
+      _mm_or_si128(_mm_cmpeq_epi8(b, v1), _mm_cmpeq_epi8(b, v2)));
+    if (mask)
+      return p + __builtin_ctz(mask);
+  }
+#endif
+  for (; p < end; p++)
+    if (*p == c1 || *p == c2)
+      return p;
+  return end;
+}
+
+static inline bool is_blank(char c)
+{
+  return c == ' ' || c == '\t' || c == '\r';
+}
+
+static inline const char *skip_blanks(const char *p, const char *end)
+{
+  while (p < end && is_blank(*p))
+    p++;
+  return p;
+}
+
+/*
+ * Convert the number at the start of [p, stop) into value. Returns a pointer
+ * past the number, or 0 if there is none. Uses fast_float rather than strtod:
+ * no locale lookups or errno, and float is rounded directly from the decimal
+ * string. Unlike strtod, fast_float does not accept a leading '+'.
+ */
+template <typename T>
+static inline const char *parse_number(const char *p, const char *stop,
+                                       T &value)
+{
+  if (p < stop && *p == '+')
+    p++;
+  fast_float::from_chars_result r = fast_float::from_chars(p, stop, value);
+  return r.ec == std::errc() ? r.ptr : 0;
+}
+
+/*
+ * Convert the feature index at the start of [p, stop) into idx. Returns a
+ * pointer past it, or 0 if there is none or it doesn't fit an int.
+ *
+ * Indices are short runs of digits, so when 8 bytes are available they are
+ * handled as one 64-bit word (SWAR): the digits are found with a bytewise
+ * range check, shifted so that the missing leading digits become zeros, and
+ * combined pairwise in three multiplications. Runs of 8 digits or more, and
+ * indices too close to the end of the line, fall back to std::from_chars.
+ */
+static inline const char *parse_index(const char *p, const char *stop,
+                                      int &idx)
+{
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__
+  if (stop - p >= 8) {
+    uint64_t x;
+    std::memcpy(&x, p, 8);
+    x ^= 0x3030303030303030ULL;
+
+    // High bit of each byte that isn't a digit, i.e., is now >= 10.
+    uint64_t non_digit = (((x & 0x7f7f7f7f7f7f7f7fULL) + 0x7676767676767676ULL)
+                          | x) & 0x8080808080808080ULL;
+    if (non_digit) {
+      int len = __builtin_ctzll(non_digit) / 8;
+      if (len == 0)
+        return 0;
+
+      // The first character is the lowest byte and the most significant
+      // digit; shift the digits up so they end at the highest byte.
+      x <<= 8 * (8 - len);
+      x = (x * 10 + (x >> 8)) & 0x00ff00ff00ff00ffULL;
+      x = (x * 100 + (x >> 16)) & 0x0000ffff0000ffffULL;
+      x = (x * 10000 + (x >> 32)) & 0x00000000ffffffffULL;
+      idx = int(x);
+      return p + len;
+    }
+  }
+#endif
+
+  std::from_chars_result r = std::from_chars(p, stop, idx);
+  return r.ec == std::errc() && idx >= 0 ? r.ptr : 0;
+}
+
+/*
+ * Writes rows into preallocated CSR arrays, starting at row first_row and
+ * nonzero first_nnz. The caller must make sure the arrays are large enough.
+ * min_index and max_index are the smallest and largest column index
+ * read, so that neither zero-based files nor the number of features need
+ * another pass over indices. Indices are written minus shift, so that the
+ * usual conversion from one-based indices happens on the way in.
  */
 template <typename T>
-struct VectorOwner {
-  // Inherit from the base Python object.
-  PyObject_HEAD
-  // The vector that VectorOwner is responsible for deallocating.
-  std::vector<T> v;
+struct CSRWriter {
+  T *data;
+  int *indices, *indptr;
+  double *labels;
+  size_t nnz_offset, n_rows, nnz;
+  int shift, min_index, max_index;
+
+  CSRWriter(T *data, int *indices, int *indptr, double *labels,
+            size_t first_row, size_t first_nnz, int shift)
+   : data(data + first_nnz), indices(indices + first_nnz),
+     indptr(indptr + first_row), labels(labels + first_row),
+     nnz_offset(first_nnz), n_rows(0), nnz(0),
+     shift(shift), min_index(INT_MAX), max_index(-1)
+  {
+  }
+
+  void add_row(double y)
+  {
+    labels[n_rows] = y;
+    indptr[n_rows] = nnz_offset + nnz;
+    n_rows++;
+  }
+
+  void add_feature(int idx, T x)
+  {
+    indices[nnz] = idx - shift;
+    data[nnz] = x;
+    nnz++;
+    if (idx < min_index)
+      min_index = idx;
+    if (idx > max_index)
+      max_index = idx;
+  }
 };
 
 /*
- * Deallocator template.
+ * Parse the contents of a single line, [p, stop), with any comment already
+ * stripped. Throws exception on failure.
  */
 template <typename T>
-static void destroy_vector_owner(PyObject *self)
+void parse_line(const char *p, const char *stop, CSRWriter<T> &out)
 {
-  // Note: explicit call to destructor because of placement new in
-  // to_1d_array. memory management for VectorOwner is performed by Python.
-  // Compiler-generated destructor will release memory from vector member.
-  VectorOwner<T> &obj = *reinterpret_cast<VectorOwner<T> *>(self);
-  obj.~VectorOwner<T>();
+  const char *q;
+
+  double y;
+  q = parse_number(skip_blanks(p, stop), stop, y);
+  if (!q || (q < stop && !is_blank(*q)))
+    throw SyntaxError("non-numeric or missing label");
 
-  self->ob_type->tp_free(self);
+  out.add_row(y);
+
+  for (p = skip_blanks(q, stop); p < stop; p = skip_blanks(q, stop)) {
+    if (stop - p >= 4 && std::memcmp(p, "qid:", 4) == 0) {
+      // query_id is not supported; skip it instead of failing.
+      for (q = p; q < stop && !is_blank(*q); q++)
+        ;
+      continue;
+    }
+
+    int idx;
+    q = parse_index(p, stop, idx);
+    if (!q)
+      throw SyntaxError("invalid feature index");
+    if (q == stop)
+      throw SyntaxError("expected ':', got end of line");
+    if (*q != ':')
+      throw SyntaxError(std::string("expected ':', got '") + *q + "'");
+
+    T x;
+    q = parse_number(q + 1, stop, x);
+    if (!q || (q < stop && !is_blank(*q)))
+      throw SyntaxError("non-numeric or missing feature value");
+
+    out.add_feature(idx, x);
+  }
 }
 
 /*
- * Since a template function can't have C linkage,
- * we instantiate the template for the types "int" and "double"
- * in the following two functions. These are used for the tp_dealloc
- * attribute of the vector owner types further below.
+ * Parse the complete lines in [p, end).
  */
-extern "C" {
-static void destroy_int_vector(PyObject *self)
+template <typename T>
+void parse_lines(const char *p, const char *end, CSRWriter<T> &out)
 {
-  destroy_vector_owner<int>(self);
+  while (p < end) {
+    // Everything from '#' to the end of the line is a comment.
+    const char *stop = find_either(p, end, '\n', '#');
+    const char *eol = stop < end && *stop == '#'
+                    ? find_either(stop, end, '\n', '\n') : stop;
+
+    if (eol == p)
+      throw SyntaxError("empty line");
+    if (*p != '#')
+      parse_line(p, stop, out);
+
+    p = eol + 1;
+  }
 }
 
-static void destroy_double_vector(PyObject *self)
+/*
+ * Count the occurrences of c in [p, end), a vector register at a time: the
+ * movemask bitmap of each comparison is popcounted, as in find_either.
+ */
+static inline size_t count_char(const char *p, const char *end, char c)
 {
-  destroy_vector_owner<double>(self);
+  size_t n = 0;
+#if defined(__AVX2__)
+  const __m256i v = _mm256_set1_epi8(c);
+  for (; end - p >= 32; p += 32) {
+    __m256i b = _mm256_loadu_si256(reinterpret_cast<const __m256i *>(p));
+    n += __builtin_popcount(_mm256_movemask_epi8(_mm256_cmpeq_epi8(b, v)));
+  }
+#elif defined(__SSE2__)
+  const __m128i v = _mm_set1_epi8(c);
+  for (; end - p >= 16; p += 16) {
+    __m128i b = _mm_loadu_si128(reinterpret_cast<const __m128i *>(p));
+    n += __builtin_popcount(_mm_movemask_epi8(_mm_cmpeq_epi8(b, v)));
+  }
+#endif
+  for (; p < end; p++)
+    n += (*p == c);
+  return n;
 }
+
+/*
+ * Count the rows in [p, end), and an upper bound on their nonzeros: the
+ * number of ':' outside comments. The bound is exact unless there are qid
+ * fields. Lines are classified exactly as in parse_lines.
+ */
+static void count_lines(const char *p, const char *end,
+                        size_t &n_rows, size_t &nnz)
+{
+  while (p < end) {
+    const char *stop = find_either(p, end, '\n', '#');
+    const char *eol = stop < end && *stop == '#'
+                    ? find_either(stop, end, '\n', '\n') : stop;
+
+    if (eol == p || *p != '#') {
+      n_rows++;
+      nnz += count_char(p, stop, ':');
+    }
+
+    p = eol + 1;
+  }
 }
 
+/*
+ * Minimum amount of input worth handing to a thread of its own.
+ */
+static const size_t MIN_BYTES_PER_THREAD = 1 << 20;
 
 /*
- * Type objects for above.
+ * A buffer split into one range per thread, at line starts, with the row
+ * and nonzero counts of each range. Range t is [bounds[t], bounds[t + 1]);
+ * its rows and nonzeros go to row_start[t] and nnz_start[t] of the output.
+ * The last entries of row_start and nnz_start are the totals.
  */
-static PyTypeObject IntVOwnerType    = { PyObject_HEAD_INIT(NULL) },
-                    DoubleVOwnerType = { PyObject_HEAD_INIT(NULL) };
+struct CountedRanges {
+  std::vector<const char *> bounds;
+  std::vector<size_t> row_start, nnz_start;
+
+  int size() const { return bounds.size() - 1; }
+  size_t n_rows() const { return row_start.back(); }
+  size_t max_nnz() const { return nnz_start.back(); }
+};
 
 /*
- * Set the fields of the owner type objects.
+ * First pass over [p, end): split it into ranges and count them in
+ * parallel, on up to max_threads threads.
  */
-static void init_type_objs()
+static CountedRanges count_ranges(const char *p, const char *end,
+                                  int max_threads)
 {
-  IntVOwnerType.tp_flags = DoubleVOwnerType.tp_flags = Py_TPFLAGS_DEFAULT;
-  IntVOwnerType.tp_name  = DoubleVOwnerType.tp_name  = "deallocator";
-  IntVOwnerType.tp_doc   = DoubleVOwnerType.tp_doc   = "deallocator object";
-  IntVOwnerType.tp_new   = DoubleVOwnerType.tp_new   = PyType_GenericNew;
+  int n_threads = 1;
+#ifdef _OPENMP
+  n_threads = std::min<size_t>(max_threads,
+                               (end - p) / MIN_BYTES_PER_THREAD);
+  n_threads = std::max(n_threads, 1);
+#endif
+
+  CountedRanges r;
+  r.bounds.resize(n_threads + 1);
+  r.bounds[0] = p;
+  r.bounds[n_threads] = end;
+  for (int t = 1; t < n_threads; t++) {
+    const char *b = std::max(p + (end - p) / n_threads * t, r.bounds[t - 1]);
+    b = find_either(b, end, '\n', '\n');
+    r.bounds[t] = b < end ? b + 1 : end;
+  }
 
-  IntVOwnerType.tp_basicsize     = sizeof(VectorOwner<int>);
-  DoubleVOwnerType.tp_basicsize  = sizeof(VectorOwner<double>);
-  IntVOwnerType.tp_dealloc       = destroy_int_vector;
-  DoubleVOwnerType.tp_dealloc    = destroy_double_vector;
+  r.row_start.assign(n_threads + 1, 0);
+  r.nnz_start.assign(n_threads + 1, 0);
+
+  // Count into locals: neighbouring entries of row_start and nnz_start
+  // share cache lines, which the threads would otherwise keep bouncing.
+  #pragma omp parallel for num_threads(n_threads) schedule(static, 1)
+  for (int t = 0; t < n_threads; t++) {
+    size_t n_rows = 0, nnz = 0;
+    count_lines(r.bounds[t], r.bounds[t + 1], n_rows, nnz);
+    r.row_start[t + 1] = n_rows;
+    r.nnz_start[t + 1] = nnz;
+  }
+
+  for (int t = 0; t < n_threads; t++) {
+    r.row_start[t + 1] += r.row_start[t];
+    r.nnz_start[t + 1] += r.nnz_start[t];
+  }
+  if (r.max_nnz() > size_t(INT_MAX))
+    throw std::overflow_error("too many nonzeros for int32 indices");
+  return r;
 }
 
-PyTypeObject &vector_owner_type(int typenum)
+/*
+ * Second pass: parse the counted ranges in parallel, each into its own slice
+ * of arrays of the counted sizes, and set indptr[n_rows]. Since the nonzero
+ * counts are upper bounds, the slices are then compacted if any came up
+ * short. Indices are stored minus shift. Returns the number of nonzeros and
+ * lowers/raises min_index and max_index to the extreme column indices read.
+ */
+template <typename T>
+static size_t fill_ranges(CountedRanges const &r, T *data, int *indices,
+                          int *indptr, double *labels, int shift,
+                          int &min_index, int &max_index)
 {
-  switch (typenum) {
-    case NPY_INT: return IntVOwnerType;
-    case NPY_DOUBLE: return DoubleVOwnerType;
+  int n_ranges = r.size();
+
+  std::vector<CSRWriter<T> > writers;
+  for (int t = 0; t < n_ranges; t++)
+    writers.push_back(CSRWriter<T>(data, indices, indptr, labels,
+                                   r.row_start[t], r.nnz_start[t], shift));
+
+  // Exceptions must not escape the parallel region; rethrow them after.
+  std::vector<std::exception_ptr> errors(n_ranges);
+
+  // Each thread parses with a writer of its own on its stack, as the
+  // writers in the vector share cache lines and are updated per feature.
+  #pragma omp parallel for num_threads(n_ranges) schedule(static, 1)
+  for (int t = 0; t < n_ranges; t++) {
+    CSRWriter<T> w = writers[t];
+    try {
+      parse_lines(r.bounds[t], r.bounds[t + 1], w);
+    } catch (...) {
+      errors[t] = std::current_exception();
+    }
+    writers[t] = w;
   }
-  throw std::logic_error("invalid argument to vector_owner_type");
-}
 
+  for (int t = 0; t < n_ranges; t++)
+    if (errors[t])
+      std::rethrow_exception(errors[t]);
+
+  // Close the gaps left by ranges with fewer nonzeros than counted.
+  size_t nnz = 0;
+  for (int t = 0; t < n_ranges; t++) {
+    CSRWriter<T> const &w = writers[t];
+    size_t gap = r.nnz_start[t] - nnz;
+    if (gap > 0) {
+      std::memmove(data + nnz, data + r.nnz_start[t], w.nnz * sizeof(T));
+      std::memmove(indices + nnz, indices + r.nnz_start[t],
+                   w.nnz * sizeof(int));
+      for (size_t i = r.row_start[t]; i < r.row_start[t + 1]; i++)
+        indptr[i] -= gap;
+    }
+    nnz += w.nnz;
+    min_index = std::min(min_index, w.min_index);
+    max_index = std::max(max_index, w.max_index);
+  }
+  indptr[r.n_rows()] = nnz;
+
+  return nnz;
+}
 
 /*
- * Convert a C++ vector to a 1d-ndarray WITHOUT memory copying.
- * Steals v's contents, leaving it empty.
- * Throws an exception if an error occurs.
+ * A CSR matrix built chunk by chunk by the readers that can't see the whole
+ * file at once. The arrays are malloc'd and, for each chunk, grown with
+ * realloc to exactly the size counted for it, then shrunk to what was
+ * actually parsed. Unlike vectors, which may double their capacity on
+ * push_back and then have to be copied into ndarrays, this never holds more
+ * than the matrix plus the slack of one chunk, and glibc serves large
+ * reallocs with mremap rather than copying. The arrays are handed over to
+ * NumPy as they are by to_arrays.
  */
 template <typename T>
-static PyObject *to_1d_array(std::vector<T> &v, int typenum)
-{
-  npy_intp dims[1] = {v.size()};
+struct CSRBuffer {
+  T *data;
+  int *indices, *indptr;
+  double *labels;
+  size_t n_rows, nnz;
+  int shift, max_threads, min_index, max_index;
+
+  CSRBuffer(int shift, int max_threads)
+   : data(0), indices(0), indptr(0), labels(0), n_rows(0), nnz(0),
+     shift(shift), max_threads(max_threads),
+     min_index(INT_MAX), max_index(-1)
+  {
+    resize(0, 0);
+    indptr[0] = 0;
+  }
 
-  // A C++ vector's elements are guaranteed to be in a contiguous array.
-  PyObject *arr = PyArray_SimpleNewFromData(1, dims, typenum, &v[0]);
+  ~CSRBuffer()
+  {
+    std::free(data);
+    std::free(indices);
+    std::free(indptr);
+    std::free(labels);
+  }
 
-  try {
-    if (!arr)
-      throw std::bad_alloc();
+  /*
+   * Parse the complete lines in [p, end) and append them.
+   */
+  void add(const char *p, const char *end)
+  {
+    CountedRanges r = count_ranges(p, end, max_threads);
+    if (nnz + r.max_nnz() > size_t(INT_MAX))
+      throw std::overflow_error("too many nonzeros for int32 indices");
+    resize(n_rows + r.n_rows(), nnz + r.max_nnz());
+
+    size_t chunk_nnz = fill_ranges(r, data + nnz, indices + nnz,
+                                   indptr + n_rows, labels + n_rows,
+                                   shift, min_index, max_index);
+    // The chunk's indptr is relative to its first nonzero.
+    if (nnz > 0)
+      for (size_t i = n_rows; i <= n_rows + r.n_rows(); i++)
+        indptr[i] += nnz;
+
+    n_rows += r.n_rows();
+    nnz += chunk_nnz;
+    if (chunk_nnz < r.max_nnz())
+      resize(n_rows, nnz);
+  }
+
+  /*
+   * Resize the arrays for n rows and m nonzeros. Never frees an array
+   * entirely, so that the ndarrays made of them always have a buffer.
+   */
+  void resize(size_t n, size_t m)
+  {
+    grow(data, m);
+    grow(indices, m);
+    grow(indptr, n + 1);
+    grow(labels, n);
+  }
 
-    VectorOwner<T> *owner = PyObject_New(VectorOwner<T>,
-                                         &vector_owner_type(typenum));
-    if (!owner)
+private:
+  template <typename U>
+  static void grow(U *&p, size_t n)
+  {
+    U *q = static_cast<U *>(std::realloc(p, std::max<size_t>(n, 1)
+                                            * sizeof(U)));
+    if (!q)
       throw std::bad_alloc();
+    p = q;
+  }
 
-    // Transfer ownership of v's contents to the VectorOwner.
-    // Note: placement new.
-    new (&owner->v) std::vector<T>();
-    owner->v.swap(v);
+  // Not copyable: the arrays are owned.
+  CSRBuffer(CSRBuffer const &);
+  CSRBuffer &operator=(CSRBuffer const &);
+};
 
-    PyArray_BASE(arr) = (PyObject *)owner;
+/*
+ * Closes a C stdio file when going out of scope.
+ */
+struct FileCloser {
+  std::FILE *f;
+  explicit FileCloser(std::FILE *f) : f(f) {}
+  ~FileCloser() { std::fclose(f); }
+};
+
+/*
+ * Parse a file that is read through stdio. Throws exception on failure.
+ *
+ * The file is read in blocks of buffer_size bytes; the incomplete line at the
+ * end of each block is carried over to the next one.
+ */
+template <typename T>
+void parse_stream(std::FILE *f,
+                size_t buffer_size,
+                CSRBuffer<T> &csr)
+{
+  std::vector<char> buffer(buffer_size);
+  size_t carry = 0;
+
+  for (;;) {
+    size_t n = std::fread(&buffer[carry], 1, buffer.size() - carry, f);
+    if (std::ferror(f))
+      throw std::ios_base::failure("error reading file");
+
+    char *begin = &buffer[0], *end = begin + carry + n;
+    bool eof = (n == 0);
+
+    // Parse up to and including the last newline, or everything at EOF.
+    char *last = end;
+    if (!eof) {
+      while (last > begin && last[-1] != '\n')
+        last--;
+      if (last == begin) {
+        // A single line doesn't fit; grow the buffer and read on.
+        carry = end - begin;
+        buffer.resize(2 * buffer.size());
+        continue;
+      }
+    }
 
-    return arr;
+    csr.add(begin, last);
 
-  } catch (std::exception const &e) {
-    // Let's assume the Python exception is already set correctly.
-    Py_XDECREF(arr);
-    throw;
+    if (eof)
+      break;
+    carry = end - last;
+    std::memmove(begin, last, carry);
   }
 }
 
+#ifdef HAVE_MMAP
+/*
+ * A file opened once by open() and closed when going out of scope, unless
+ * it has been handed over to stdio by to_stdio(). All readers share this
+ * descriptor rather than reopening the path: opening and closing a FIFO
+ * would take its writer's connection, and whatever it wrote would be lost.
+ * regular and size are only set for regular files.
+ */
+struct InputFile {
+  int fd;
+  bool regular;
+  size_t size;
 
-static PyObject *to_csr(std::vector<double> &data,
-                        std::vector<int> &indices,
-                        std::vector<int> &indptr,
-                        std::vector<double> &labels)
-{
-  // We could do with a smart pointer to Python objects here.
-  std::exception const *exc = 0;
-  PyObject *data_arr = 0,
-           *indices_arr = 0,
-           *indptr_arr = 0,
-           *labels_arr = 0,
-           *ret_tuple = 0;
+  InputFile() : fd(-1), regular(false), size(0) {}
 
-  try {
-    data_arr    = to_1d_array(data, NPY_DOUBLE);
-    indices_arr = to_1d_array(indices, NPY_INT);
-    indptr_arr  = to_1d_array(indptr, NPY_INT);
-    labels_arr  = to_1d_array(labels, NPY_DOUBLE);
-
-    ret_tuple = Py_BuildValue("OOOO",
-                              data_arr, indices_arr,
-                              indptr_arr, labels_arr);
-  } catch (std::exception const &e) {
-    exc = &e;
+  void open(char const *file_path)
+  {
+    fd = ::open(file_path, O_RDONLY);
+    if (fd < 0)
+      throw std::ios_base::failure("File doesn't exist!");
+
+    struct stat st;
+    if (::fstat(fd, &st) == 0 && S_ISREG(st.st_mode)) {
+      regular = true;
+      size = st.st_size;
+    }
   }
 
-  // Py_BuildValue increases the reference count of each array,
-  // so we need to decrease it before returning the tuple,
-  // regardless of error status.
-  Py_XDECREF(data_arr);
-  Py_XDECREF(indices_arr);
-  Py_XDECREF(indptr_arr);
-  Py_XDECREF(labels_arr);
+  std::FILE *to_stdio()
+  {
+    std::FILE *f = ::fdopen(fd, "rb");
+    if (!f)
+      throw std::ios_base::failure("error reading file");
+    fd = -1;
+    return f;
+  }
 
-  if (exc)
-    throw *exc;
+  ~InputFile()
+  {
+    if (fd >= 0)
+      ::close(fd);
+  }
+};
 
-  return ret_tuple;
-}
+/*
+ * A regular file mapped read-only into memory by map(), unmapped by unmap()
+ * or when going out of scope. mapped is false if the file can't be mapped.
+ */
+struct MappedFile {
+  bool mapped;
+  const char *data;
+  size_t size;
+
+  MappedFile() : mapped(false), data(0), size(0) {}
+
+  void map(int fd, size_t file_size)
+  {
+    if (file_size == 0) {
+      // mmap doesn't do empty mappings.
+      mapped = true;
+      data = "";
+      return;
+    }
+
+    int flags = MAP_PRIVATE;
+#ifdef MAP_POPULATE
+    // Fault in all pages up front rather than one at a time while parsing.
+    flags |= MAP_POPULATE;
+#endif
+    void *addr = ::mmap(0, file_size, PROT_READ, flags, fd, 0);
+    if (addr == MAP_FAILED)
+      return;
+    ::madvise(addr, file_size, MADV_SEQUENTIAL);
+
+    mapped = true;
+    data = static_cast<const char *>(addr);
+    size = file_size;
+  }
+
+  void unmap()
+  {
+    if (size > 0)
+      ::munmap(const_cast<char *>(data), size);
+    mapped = false;
+    data = 0;
+    size = 0;
+  }
 
+  ~MappedFile() { unmap(); }
+};
+#endif
 
+#ifdef HAVE_IO_URING
 /*
- * Parsing.
+ * Number of chunks read ahead by the io_uring reader, and the alignment
+ * required of buffers, offsets and lengths for O_DIRECT reads.
  */
+static const unsigned IO_URING_DEPTH = 16;
+static const size_t IO_URING_ALIGN = 4096;
 
-class SyntaxError : public std::runtime_error {
+/*
+ * Asynchronous chunked reader built directly on the io_uring system calls,
+ * so that liburing isn't needed to build the extension.
+ *
+ * The reader owns depth buffers ("slots") of chunk_size bytes each. read()
+ * queues a read into a slot; wait() blocks until that slot's read completes
+ * and returns the number of bytes read. ok() is false if io_uring is not
+ * available, in which case nothing else may be called.
+ */
+class IoUringReader {
 public:
-  SyntaxError(std::string const &msg)
-   : std::runtime_error(msg + " in SVMlight/libSVM file")
+  IoUringReader(int fd, unsigned depth, size_t chunk_size)
+   : fd(fd), chunk_size(chunk_size), ring_fd(-1), in_flight(0),
+     sq_ptr(MAP_FAILED), cq_ptr(MAP_FAILED), sqe_ptr(MAP_FAILED),
+     buffers(0), done(depth, false), result(depth, 0)
+  {
+    if (::posix_memalign(reinterpret_cast<void **>(&buffers), IO_URING_ALIGN,
+                         depth * chunk_size) != 0)
+      throw std::bad_alloc();
+
+    struct io_uring_params p;
+    std::memset(&p, 0, sizeof(p));
+    int rfd = ::syscall(__NR_io_uring_setup, depth, &p);
+    if (rfd < 0)
+      return;
+    // IORING_OP_READ needs Linux 5.6, the release that added this feature.
+    if (!(p.features & IORING_FEAT_RW_CUR_POS)) {
+      ::close(rfd);
+      return;
+    }
+
+    sq_size = p.sq_off.array + p.sq_entries * sizeof(unsigned);
+    cq_size = p.cq_off.cqes + p.cq_entries * sizeof(struct io_uring_cqe);
+    sqe_size = p.sq_entries * sizeof(struct io_uring_sqe);
+    sq_ptr = ::mmap(0, sq_size, PROT_READ | PROT_WRITE,
+                    MAP_SHARED | MAP_POPULATE, rfd, IORING_OFF_SQ_RING);
+    cq_ptr = ::mmap(0, cq_size, PROT_READ | PROT_WRITE,
+                    MAP_SHARED | MAP_POPULATE, rfd, IORING_OFF_CQ_RING);
+    sqe_ptr = ::mmap(0, sqe_size, PROT_READ | PROT_WRITE,
+                     MAP_SHARED | MAP_POPULATE, rfd, IORING_OFF_SQES);
+    if (sq_ptr == MAP_FAILED || cq_ptr == MAP_FAILED
+     || sqe_ptr == MAP_FAILED) {
+      ::close(rfd);
+      return;
+    }
+
+    char *sq = static_cast<char *>(sq_ptr), *cq = static_cast<char *>(cq_ptr);
+    sq_tail  = reinterpret_cast<unsigned *>(sq + p.sq_off.tail);
+    sq_mask  = reinterpret_cast<unsigned *>(sq + p.sq_off.ring_mask);
+    sq_array = reinterpret_cast<unsigned *>(sq + p.sq_off.array);
+    sqes     = static_cast<struct io_uring_sqe *>(sqe_ptr);
+    cq_head  = reinterpret_cast<unsigned *>(cq + p.cq_off.head);
+    cq_tail  = reinterpret_cast<unsigned *>(cq + p.cq_off.tail);
+    cq_mask  = reinterpret_cast<unsigned *>(cq + p.cq_off.ring_mask);
+    cqes     = reinterpret_cast<struct io_uring_cqe *>(cq + p.cq_off.cqes);
+    ring_fd = rfd;
+  }
+
+  ~IoUringReader()
   {
+    // The kernel may still be writing into our buffers; let it finish.
+    try {
+      while (in_flight > 0)
+        reap();
+    } catch (std::exception const &) {
+    }
+
+    if (sq_ptr != MAP_FAILED)
+      ::munmap(sq_ptr, sq_size);
+    if (cq_ptr != MAP_FAILED)
+      ::munmap(cq_ptr, cq_size);
+    if (sqe_ptr != MAP_FAILED)
+      ::munmap(sqe_ptr, sqe_size);
+    if (ring_fd >= 0)
+      ::close(ring_fd);
+    std::free(buffers);
   }
+
+  bool ok() const { return ring_fd >= 0; }
+
+  char *buffer(unsigned slot) { return buffers + slot * chunk_size; }
+
+  /*
+   * Start reading bytes [from, len) of the chunk of length len at offset
+   * into the same place in slot. For O_DIRECT, the end is rounded up to the
+   * alignment; the read stops at EOF anyway.
+   */
+  void read(unsigned slot, size_t offset, size_t len, size_t from = 0)
+  {
+    len = ((len + IO_URING_ALIGN - 1) & ~(IO_URING_ALIGN - 1)) - from;
+
+    unsigned tail = *sq_tail;
+    unsigned index = tail & *sq_mask;
+    struct io_uring_sqe *sqe = &sqes[index];
+    std::memset(sqe, 0, sizeof(*sqe));
+    sqe->opcode = IORING_OP_READ;
+    sqe->fd = fd;
+    sqe->addr = reinterpret_cast<unsigned long>(buffer(slot) + from);
+    sqe->len = len;
+    sqe->off = offset + from;
+    sqe->user_data = slot;
+    sq_array[index] = index;
+    __atomic_store_n(sq_tail, tail + 1, __ATOMIC_RELEASE);
+
+    while (::syscall(__NR_io_uring_enter, ring_fd, 1, 0, 0, 0, 0) < 0)
+      if (errno != EINTR)
+        throw std::ios_base::failure("io_uring_enter failed");
+    in_flight++;
+  }
+
+  /*
+   * Wait for the read into slot to complete; return the number of bytes read.
+   */
+  size_t wait(unsigned slot)
+  {
+    while (!done[slot])
+      reap();
+    done[slot] = false;
+    if (result[slot] < 0)
+      throw std::ios_base::failure(std::strerror(-result[slot]));
+    return result[slot];
+  }
+
+private:
+  /*
+   * Block until one completion is available and record it.
+   */
+  void reap()
+  {
+    for (;;) {
+      unsigned head = *cq_head;
+      if (head != __atomic_load_n(cq_tail, __ATOMIC_ACQUIRE)) {
+        struct io_uring_cqe &cqe = cqes[head & *cq_mask];
+        done[cqe.user_data] = true;
+        result[cqe.user_data] = cqe.res;
+        __atomic_store_n(cq_head, head + 1, __ATOMIC_RELEASE);
+        in_flight--;
+        return;
+      }
+      if (::syscall(__NR_io_uring_enter, ring_fd, 0, 1,
+                    IORING_ENTER_GETEVENTS, 0, 0) < 0 && errno != EINTR)
+        throw std::ios_base::failure("io_uring_enter failed");
+    }
+  }
+
+  int fd;
+  size_t chunk_size;
+  int ring_fd;
+  unsigned in_flight;
+  void *sq_ptr, *cq_ptr, *sqe_ptr;
+  size_t sq_size, cq_size, sqe_size;
+  unsigned *sq_tail, *sq_mask, *sq_array, *cq_head, *cq_tail, *cq_mask;
+  struct io_uring_sqe *sqes;
+  struct io_uring_cqe *cqes;
+  char *buffers;
+  std::vector<bool> done;
+  std::vector<int> result;
 };
 
 /*
- * Parse single line. Throws exception on failure.
+ * Parse the regular file open on fd, of the given size, read through
+ * io_uring. The page cache is bypassed with O_DIRECT where the filesystem
+ * allows it. Up to IO_URING_DEPTH chunks are read ahead while earlier ones
+ * are parsed; lines that straddle two chunks are reassembled in a small
+ * carry-over buffer.
+ *
+ * Returns false, without parsing anything and with fd as it was, if
+ * io_uring is unavailable.
  */
-void parse_line(const std::string& line,
-                std::vector<double> &data,
-                std::vector<int> &indices,
-                std::vector<int> &indptr,
-                std::vector<double> &labels)
+template <typename T>
+bool parse_io_uring(int fd, size_t size,
+                    size_t buffer_size,
+                    CSRBuffer<T> &csr)
 {
-  if (line.length() == 0)
-    throw SyntaxError("empty line");
+  size_t chunk_size = std::max(buffer_size / IO_URING_DEPTH, size_t(1) << 20);
+  chunk_size = (chunk_size + IO_URING_ALIGN - 1) & ~(IO_URING_ALIGN - 1);
+  size_t n_chunks = (size + chunk_size - 1) / chunk_size;
+  unsigned depth = std::max<size_t>(1, std::min<size_t>(IO_URING_DEPTH,
+                                                        n_chunks));
+
+  IoUringReader reader(fd, depth, chunk_size);
+  if (!reader.ok())
+    return false;
+
+  // Reads are at explicit offsets, so the file position is left alone. If
+  // the filesystem refuses O_DIRECT, read through the page cache.
+  int fl = ::fcntl(fd, F_GETFL);
+  bool direct = fl != -1 && ::fcntl(fd, F_SETFL, fl | O_DIRECT) == 0;
+
+  for (unsigned k = 0; k < depth && k < n_chunks; k++) {
+    size_t offset = k * chunk_size;
+    reader.read(k, offset, std::min(chunk_size, size - offset));
+  }
 
-  if (line[0] == '#')
-    return;
+  std::vector<char> carry;
+  for (size_t k = 0; k < n_chunks; k++) {
+    unsigned slot = k % depth;
+    size_t offset = k * chunk_size;
+    size_t len = std::min(chunk_size, size - offset);
+    size_t got = reader.wait(slot);
+    while (got < len) {
+      // Short reads are allowed; ask for the rest. O_DIRECT reads must
+      // start aligned, so back up to the alignment and reread a little.
+      size_t from = direct ? got & ~(IO_URING_ALIGN - 1) : got;
+      reader.read(slot, offset, len, from);
+      size_t more = reader.wait(slot);
+      if (from + more <= got)
+        throw std::ios_base::failure("unexpected end of file");
+      got = from + more;
+    }
 
-  // FIXME: we shouldn't be parsing line-by-line.
-  // Also, we might catch more syntax errors with failbit.
-  std::istringstream in(line);
-  in.exceptions(std::ios::badbit);
+    const char *p = reader.buffer(slot), *end = p + len;
+
+    // Complete the line carried over from the previous chunk.
+    if (!carry.empty()) {
+      const char *nl = find_either(p, end, '\n', '\n');
+      if (nl == end) {
+        carry.insert(carry.end(), p, end);
+        p = end;
+      } else {
+        carry.insert(carry.end(), p, nl + 1);
+        csr.add(&carry[0], &carry[0] + carry.size());
+        carry.clear();
+        p = nl + 1;
+      }
+    }
 
-  double y;
-  if (!(in >> y)) {
-    throw SyntaxError("non-numeric or missing label");
+    const char *last = end;
+    while (last > p && last[-1] != '\n')
+      last--;
+    csr.add(p, last);
+    carry.insert(carry.end(), last, end);
+
+    // Reuse the slot for the chunk depth positions ahead.
+    if (k + depth < n_chunks) {
+      offset = (k + depth) * chunk_size;
+      reader.read(slot, offset, std::min(chunk_size, size - offset));
+    }
   }
 
-  labels.push_back(y);
-  indptr.push_back(data.size());
+  if (!carry.empty())
+    csr.add(&carry[0], &carry[0] + carry.size());
+  return true;
+}
+#endif
+
+/*
+ * What to subtract from column indices as they are parsed. zero_based is 1
+ * (leave as is), 0 (shift) or -1 (shift if no index is 0). Whether auto
+ * needs the shift is only known once all indices have been read, so files
+ * are assumed to be one-based, as they usually are, and shift_indices undoes
+ * the shift for those that turn out not to be.
+ */
+static inline int parse_shift(int zero_based)
+{
+  return zero_based == 1 ? 0 : 1;
+}
 
-  char c;
-  double x;
-  unsigned idx;
+/*
+ * Fix up column indices that were stored minus shift, in place, and return
+ * the number of features, i.e. the largest index after conversion plus one.
+ * That is INT_MAX + 1 for a zero-based file with index INT_MAX, hence the
+ * wider return type.
+ */
+Py_ssize_t shift_indices(int *indices, size_t n, int zero_based, int shift,
+                  int min_index, int max_index)
+{
+  if (n == 0)
+    return 0;
 
-  while (in >> idx >> c >> x) {
-    if (c != ':')
-      throw SyntaxError(std::string("expected ':', got '") + c + "'");
-    indices.push_back(int(idx));
-    data.push_back(x);
+  int wanted = zero_based == -1 ? min_index > 0 : zero_based == 0;
+  int delta = shift - wanted;
+  // Plain loop over a contiguous int array; vectorized by the compiler.
+  if (delta != 0)
+    for (size_t i = 0; i < n; i++)
+      indices[i] += delta;
+  return Py_ssize_t(max_index) + 1 - wanted;
+}
+
+/*
+ * Owns a reference to a Python object and releases it when going out of
+ * scope.
+ */
+struct PyRef {
+  PyObject *obj;
+  explicit PyRef(PyObject *obj) : obj(obj) {}
+  ~PyRef() { Py_XDECREF(obj); }
+};
+
+/*
+ * Releases the GIL for as long as it is in scope, so that other Python
+ * threads can run while we parse or write files. Nothing in that scope may
+ * touch Python objects. Unlike Py_BEGIN/END_ALLOW_THREADS, this also
+ * reacquires the GIL when an exception is thrown.
+ */
+class AllowThreads {
+public:
+  AllowThreads() : state(PyEval_SaveThread()) {}
+  ~AllowThreads() { PyEval_RestoreThread(state); }
+
+private:
+  PyThreadState *state;
+};
+
+/*
+ * Allocate an uninitialized 1d-ndarray that owns its memory.
+ */
+static PyObject *new_array(size_t n, int typenum)
+{
+  npy_intp dims[1] = {npy_intp(n)};
+  PyObject *arr = PyArray_EMPTY(1, dims, typenum, 0);
+  if (!arr)
+    throw std::bad_alloc();
+  return arr;
+}
+
+/*
+ * Shrink a 1d-ndarray allocated by new_array to n elements.
+ */
+static void shrink_array(PyObject *arr, size_t n)
+{
+  npy_intp dims[1] = {npy_intp(n)};
+  PyArray_Dims shape = {dims, 1};
+  PyObject *ret = PyArray_Resize(reinterpret_cast<PyArrayObject *>(arr),
+                                 &shape, 0, NPY_CORDER);
+  if (!ret)
+    throw std::bad_alloc();
+  Py_DECREF(ret);
+}
+
+/*
+ * Wrap a malloc'd buffer of n elements in a 1d-ndarray that frees it when
+ * it is garbage collected. Takes ownership of ptr even on failure.
+ */
+static void free_capsule(PyObject *capsule)
+{
+  std::free(PyCapsule_GetPointer(capsule, 0));
+}
+
+static PyObject *own_array(void *ptr, size_t n, int typenum)
+{
+  PyObject *capsule = PyCapsule_New(ptr, 0, free_capsule);
+  if (!capsule) {
+    std::free(ptr);
+    throw std::bad_alloc();
   }
+
+  npy_intp dims[1] = {npy_intp(n)};
+  PyObject *arr = PyArray_SimpleNewFromData(1, dims, typenum, ptr);
+  if (!arr) {
+    Py_DECREF(capsule);
+    throw std::bad_alloc();
+  }
+  // Steals the reference to capsule, even on failure.
+  if (PyArray_SetBaseObject((PyArrayObject *)arr, capsule) < 0) {
+    Py_DECREF(arr);
+    throw std::bad_alloc();
+  }
+  return arr;
 }
 
 /*
- * Parse entire file. Throws exception on failure.
+ * Take p away from its owner, leaving it null.
  */
-void parse_file(char const *file_path,
-                size_t buffer_size,
-                std::vector<double> &data,
-                std::vector<int> &indices,
-                std::vector<int> &indptr,
-                std::vector<double> &labels)
+template <typename U>
+static U *release(U *&p)
 {
-  std::vector<char> buffer(buffer_size);
+  U *q = p;
+  p = 0;
+  return q;
+}
 
-  std::ifstream file_stream;
-  file_stream.exceptions(std::ios::badbit);
-  file_stream.rdbuf()->pubsetbuf(&buffer[0], buffer_size);
-  file_stream.open(file_path);
+/*
+ * Finish a CSR built by one of the chunked readers and return it as a tuple.
+ * The ndarrays take over csr's buffers, which are left empty.
+ */
+template <typename T>
+static PyObject *to_arrays(CSRBuffer<T> &csr, int zero_based)
+{
+  Py_ssize_t n_features;
+  {
+    AllowThreads nogil;
+    n_features = shift_indices(csr.indices, csr.nnz, zero_based, csr.shift,
+                               csr.min_index, csr.max_index);
+  }
 
-  if (!file_stream)
+  PyRef data_arr(own_array(release(csr.data), csr.nnz,
+                           npy_typenum<T>::value));
+  PyRef indices_arr(own_array(release(csr.indices), csr.nnz, NPY_INT));
+  PyRef indptr_arr(own_array(release(csr.indptr), csr.n_rows + 1, NPY_INT));
+  PyRef labels_arr(own_array(release(csr.labels), csr.n_rows, NPY_DOUBLE));
+
+  return Py_BuildValue("OOOOn", data_arr.obj, indices_arr.obj,
+                       indptr_arr.obj, labels_arr.obj, n_features);
+}
+
+/*
+ * Parse the complete lines in [p, end) straight into ndarrays and return
+ * them as a tuple.
+ *
+ * This takes two passes over the buffer (see count_ranges and fill_ranges),
+ * so that the ndarrays can be allocated at their final size, or a little
+ * more, between the two.
+ */
+template <typename T>
+static PyObject *load_buffer(const char *p, const char *end, int zero_based,
+                             int max_threads)
+{
+  CountedRanges r;
+  {
+    AllowThreads nogil;
+    r = count_ranges(p, end, max_threads);
+  }
+  size_t n_rows = r.n_rows(), max_nnz = r.max_nnz();
+
+  PyRef data_arr(new_array(max_nnz, npy_typenum<T>::value)),
+        indices_arr(new_array(max_nnz, NPY_INT)),
+        indptr_arr(new_array(n_rows + 1, NPY_INT)),
+        labels_arr(new_array(n_rows, NPY_DOUBLE));
+
+  T *data = static_cast<T *>(PyArray_DATA((PyArrayObject *)data_arr.obj));
+  int *indices = static_cast<int *>(PyArray_DATA((PyArrayObject *)
+                                                 indices_arr.obj));
+  int *indptr = static_cast<int *>(PyArray_DATA((PyArrayObject *)
+                                                indptr_arr.obj));
+  double *labels = static_cast<double *>(PyArray_DATA((PyArrayObject *)
+                                                      labels_arr.obj));
+
+  size_t nnz;
+  Py_ssize_t n_features;
+  {
+    AllowThreads nogil;
+
+    int min_index = INT_MAX, max_index = -1;
+    int shift = parse_shift(zero_based);
+    nnz = fill_ranges(r, data, indices, indptr, labels, shift,
+                      min_index, max_index);
+    n_features = shift_indices(indices, nnz, zero_based, shift,
+                               min_index, max_index);
+  }
+
+  if (nnz < max_nnz) {
+    shrink_array(data_arr.obj, nnz);
+    shrink_array(indices_arr.obj, nnz);
+  }
+
+  return Py_BuildValue("OOOOn", data_arr.obj, indices_arr.obj,
+                       indptr_arr.obj, labels_arr.obj, n_features);
+}
+
+/*
+ * Parse the file into a CSR with T-valued data and return it as a tuple.
+ * Throws exception on failure.
+ *
+ * Regular files are mapped into memory and parsed in place with load_buffer.
+ * Anything that can't be mapped (pipes, character devices, platforms without
+ * mmap) goes through parse_stream. If use_io_uring is set and io_uring is
+ * available, the file is read with parse_io_uring instead, which is faster
+ * than mmap for large files not in the page cache. Parsing uses up to
+ * max_threads threads.
+ */
+template <typename T>
+static PyObject *load(char const *file_path, size_t buffer_size,
+                      bool use_io_uring, int zero_based, int max_threads)
+{
+  CSRBuffer<T> csr(parse_shift(zero_based), max_threads);
+  std::FILE *f;
+
+#ifdef HAVE_MMAP
+  // Opening a FIFO blocks until there is a writer.
+  InputFile file;
+  {
+    AllowThreads nogil;
+    file.open(file_path);
+  }
+
+  if (file.regular) {
+#ifdef HAVE_IO_URING
+    if (use_io_uring) {
+      bool parsed;
+      {
+        AllowThreads nogil;
+        parsed = parse_io_uring(file.fd, file.size, buffer_size, csr);
+      }
+      if (parsed)
+        return to_arrays(csr, zero_based);
+    }
+#endif
+
+    MappedFile mapping;
+    {
+      AllowThreads nogil;
+      mapping.map(file.fd, file.size);
+    }
+    if (mapping.mapped) {
+      PyObject *ret = load_buffer<T>(mapping.data,
+                                     mapping.data + mapping.size,
+                                     zero_based, max_threads);
+      // Tearing down a large mapping takes a while, too.
+      AllowThreads nogil;
+      mapping.unmap();
+      return ret;
+    }
+  }
+
+  f = file.to_stdio();
+#else
+  f = std::fopen(file_path, "rb");
+  if (!f)
     throw std::ios_base::failure("File doesn't exist!");
+#endif
+  FileCloser closer(f);
 
-  std::string line;
-  while (std::getline(file_stream, line))
-    parse_line(line, data, indices, indptr, labels);
-  indptr.push_back(data.size());
+  {
+    AllowThreads nogil;
+    parse_stream(f, buffer_size, csr);
+  }
+  return to_arrays(csr, zero_based);
 }
 
 
@@ -277,19 +1262,29 @@ static PyObject *load_svmlight_file(PyObject *self, PyObject *args)
   try {
     // Read function arguments.
     char const *file_path;
-    int buffer_mb;
+    int buffer_mb, zero_based, single_precision, use_io_uring, n_threads;
 
-    if (!PyArg_ParseTuple(args, "si", &file_path, &buffer_mb))
+    if (!PyArg_ParseTuple(args, "siiiii", &file_path, &buffer_mb,
+                          &zero_based, &single_precision, &use_io_uring,
+                          &n_threads))
       return 0;
 
     buffer_mb = std::max(buffer_mb, 1);
     size_t buffer_size = buffer_mb * 1024 * 1024;
 
-    std::vector<double> data, labels;
-    std::vector<int> indices, indptr;
-    parse_file(file_path, buffer_size, data, indices, indptr, labels);
+    // n_threads <= 0 means as many as OpenMP would use by default.
+#ifdef _OPENMP
+    if (n_threads <= 0)
+      n_threads = omp_get_max_threads();
+#endif
+    n_threads = std::max(n_threads, 1);
 
-    return to_csr(data, indices, indptr, labels);
+    if (single_precision)
+      return load<float>(file_path, buffer_size, use_io_uring, zero_based,
+                         n_threads);
+    else
+      return load<double>(file_path, buffer_size, use_io_uring, zero_based,
+                          n_threads);
 
   } catch (SyntaxError const &e) {
     PyErr_SetString(PyExc_ValueError, e.what());
@@ -309,6 +1304,118 @@ static PyObject *load_svmlight_file(PyObject *self, PyObject *args)
 }
 }
 
+/*
+ * Writing.
+ */
+
+/*
+ * An exception for a failed system call, carrying errno so that the message
+ * says why, e.g. "cannot open foo.txt: Permission denied".
+ */
+static std::ios_base::failure os_error(std::string const &what)
+{
+  return std::ios_base::failure(what,
+                                std::error_code(errno,
+                                                std::generic_category()));
+}
+
+/*
+ * Buffered output for the dump loop. Numbers are formatted with
+ * std::to_chars, which involves no locale or stream state and produces the
+ * shortest representation that reads back to the same value. The buffer is
+ * only handed to fwrite when it is nearly full.
+ */
+class Writer {
+public:
+  explicit Writer(std::FILE *f) : f(f), buffer(1 << 20), pos(0) {}
+
+  void put(char c)
+  {
+    reserve(1);
+    buffer[pos++] = c;
+  }
+
+  template <typename N>
+  void put_number(N x)
+  {
+    reserve(MAX_NUMBER_LENGTH);
+    char *begin = &buffer[0];
+    pos = std::to_chars(begin + pos, begin + buffer.size(), x).ptr - begin;
+  }
+
+  void flush()
+  {
+    if (std::fwrite(&buffer[0], 1, pos, f) != pos)
+      throw os_error("error writing file");
+    pos = 0;
+  }
+
+private:
+  // Longest output of to_chars for a double or int, with room to spare.
+  static const size_t MAX_NUMBER_LENGTH = 32;
+
+  void reserve(size_t n)
+  {
+    if (buffer.size() - pos < n)
+      flush();
+  }
+
+  std::FILE *f;
+  std::vector<char> buffer;
+  size_t pos;
+};
+
+
+/*
+ * Write the CSR matrix with T-valued data to file_path. Throws exception on
+ * failure. Values are written in the shortest form that reads back to the
+ * same T, so float data doesn't get the digits of its double expansion.
+ */
+template <typename T>
+static void dump(char const *file_path, const T *data, const int *indices,
+                 const int *indptr, const double *y, int n_samples,
+                 int zero_based)
+{
+  std::FILE *f = std::fopen(file_path, "wb");
+  if (!f)
+    throw os_error(std::string("cannot open ") + file_path + " for writing");
+  FileCloser closer(f);
+  Writer out(f);
+
+  int idx;
+  for (int i=0; i < n_samples; i++) {
+    out.put_number(y[i]);
+    out.put(' ');
+    for (int jj=indptr[i]; jj < indptr[i+1]; jj++) {
+      idx = indices[jj];
+      if (!zero_based)
+        idx++;
+      out.put_number(idx);
+      out.put(':');
+      out.put_number(data[jj]);
+      out.put(' ');
+    }
+    out.put('\n');
+  }
+
+  out.flush();
+}
+
+
+/*
+ * Check that arr is a contiguous, aligned 1d-array of the given type, so
+ * that the dump loop can walk it through a plain C pointer.
+ */
+static void check_array(PyArrayObject *arr, int typenum, char const *name)
+{
+  if (PyArray_NDIM(arr) != 1 || PyArray_TYPE(arr) != typenum
+   || !PyArray_ISCARRAY_RO(arr))
+    throw std::invalid_argument(std::string(name)
+                                + " must be a contiguous 1d-array of "
+                                + (typenum == NPY_INT ? "int32" : "float64"));
+}
+
+
 static const char dump_svmlight_file_doc[] =
   "Dump CSR matrix to a file in svmlight format.";
 
@@ -331,32 +1438,44 @@ static PyObject *dump_svmlight_file(PyObject *self, PyObject *args)
                           &zero_based))
       return 0;
 
-    int n_samples = indptr_array->dimensions[0] - 1;
-    double *data = (double*) data_array->data;
-    int *indices = (int*) indices_array->data;
-    int *indptr = (int*) indptr_array->data;
-    double *y = (double*) label_array->data;
-
-    std::ofstream fout;
-    fout.open(file_path, std::ofstream::out);
-
-    int idx;
-    for (int i=0; i < n_samples; i++) {
-      fout << y[i] << " ";
-      for (int jj=indptr[i]; jj < indptr[i+1]; jj++) {
-        idx = indices[jj];
-        if (!zero_based)
-          idx++;
-        fout << idx << ":" << data[jj] << " ";
-      }
-      fout << std::endl;
+    check_array(indices_array, NPY_INT, "indices");
+    check_array(indptr_array, NPY_INT, "indptr");
+    check_array(label_array, NPY_DOUBLE, "y");
+    if (PyArray_NDIM(data_array) != 1 || !PyArray_ISCARRAY_RO(data_array))
+      throw std::invalid_argument("data must be a contiguous 1d-array");
+
+    int typenum = PyArray_TYPE(data_array);
+    if (typenum != NPY_FLOAT && typenum != NPY_DOUBLE)
+      throw std::invalid_argument("data must be float32 or float64");
+
+    int n_samples = PyArray_DIM(indptr_array, 0) - 1;
+    void *data = PyArray_DATA(data_array);
+    int *indices = static_cast<int *>(PyArray_DATA(indices_array));
+    int *indptr = static_cast<int *>(PyArray_DATA(indptr_array));
+    double *y = static_cast<double *>(PyArray_DATA(label_array));
+
+    {
+      // The arrays are kept alive by args; from here on only the raw
+      // pointers and the file are used.
+      AllowThreads nogil;
+
+      if (typenum == NPY_FLOAT)
+        dump(file_path, static_cast<float *>(data),
+             indices, indptr, y, n_samples, zero_based);
+      else
+        dump(file_path, static_cast<double *>(data),
+             indices, indptr, y, n_samples, zero_based);
     }
 
-    fout.close();
-
     Py_INCREF(Py_None);
     return Py_None;
 
+  } catch (std::ios_base::failure const &e) {
+    PyErr_SetString(PyExc_IOError, e.what());
+    return 0;
+  } catch (std::invalid_argument const &e) {
+    PyErr_SetString(PyExc_TypeError, e.what());
+    return 0;
   } catch (std::exception const &e) {
     std::string msg("error in SVMlight/libSVM writer: ");
     msg += e.what();
@@ -399,11 +1518,6 @@ PyMODINIT_FUNC PyInit__svmlight_loader(void)
   Py_Initialize();
   import_array();
 
-  init_type_objs();
-  if (PyType_Ready(&DoubleVOwnerType) < 0
-  || PyType_Ready(&IntVOwnerType)    < 0)
-  return NULL;
-
   return PyModule_Create(&_svmlight_loader_definition);
 
 }
@@ -412,11 +1526,6 @@ PyMODINIT_FUNC init_svmlight_loader(void)
 {
   _import_array();
 
-  init_type_objs();
-  if (PyType_Ready(&DoubleVOwnerType) < 0
-   || PyType_Ready(&IntVOwnerType)    < 0)
-    return;
-
   Py_InitModule3("_svmlight_loader",
                  svmlight_format_methods,
                  svmlight_format_doc);
@@ -1,13 +1,54 @@
 from distutils.core import setup, Extension
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError
+import os
+import shutil
+import tempfile
+
 import numpy as np
 
+
+def has_openmp(compiler):
+    """Whether compiler can build and link an OpenMP program with -fopenmp.
+
+    Apple clang, for one, rejects the flag; the extension then builds
+    single-threaded."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'omp.cpp')
+        with open(src, 'w') as f:
+            f.write('#include <omp.h>\n'
+                    'int main() { return omp_get_max_threads() < 1; }\n')
+        objects = compiler.compile([src], output_dir=tmpdir,
+                                   extra_postargs=['-fopenmp'])
+        compiler.link_executable(objects, os.path.join(tmpdir, 'omp'),
+                                 extra_postargs=['-fopenmp'])
+        return True
+    except (CCompilerError, DistutilsExecError):
+        return False
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class BuildExt(build_ext):
+    def build_extensions(self):
+        if has_openmp(self.compiler):
+            for e in self.extensions:
+                e.extra_compile_args.append('-fopenmp')
+                e.extra_link_args.append('-fopenmp')
+        build_ext.build_extensions(self)
+
+
+# C++17 for std::from_chars/to_chars; see README.rst for compiler versions.
 ext = Extension('_svmlight_loader',
                 include_dirs = [np.get_include(),'.'],
-                extra_compile_args=['-O3'],
-                sources = ['_svmlight_loader.cpp'])
+                extra_compile_args=['-O3', '-std=c++17'],
+                sources = ['_svmlight_loader.cpp'],
+                depends = ['fast_float.h'])
 
 setup (name = 'svmlight-loader',
        version = '0.1',
        description = 'Fast loader for the svmlight/libsvm sparse data format.',
        ext_modules = [ext],
+       cmdclass = {'build_ext': BuildExt},
        py_modules = ['svmlight_loader',])
@@ -5,7 +5,13 @@ loader for the svmlight / libsvm sparse dataset format.  """
 #          Lars Buitinck <L.J.Buitinck@uva.nl>
 # License: Simple BSD.
 
+import concurrent.futures
+import hashlib
+import os
 import os.path
+import shutil
+import stat
+import tempfile
 
 import numpy as np
 import scipy.sparse as sp
@@ -15,7 +21,8 @@ from _svmlight_loader import _dump_svmlight_file
 
 
 def load_svmlight_file(file_path, n_features=None, dtype=None,
-                       buffer_mb=40, zero_based="auto"):
+                       buffer_mb=40, zero_based="auto", use_io_uring=False,
+                       cache_dir=None, n_threads=None):
     """Load datasets in the svmlight / libsvm format into sparse CSR matrix
 
     This format is a text-based format, with one sample per line. It does
@@ -28,10 +35,10 @@ def load_svmlight_file(file_path, n_features=None, dtype=None,
     libsvm command line programs.
 
     Parsing a text based source can be expensive. When working on
-    repeatedly on the same dataset, it is recommended to wrap this
-    loader with joblib.Memory.cache to store a memmapped backup of the
-    CSR results of the first call and benefit from the near instantaneous
-    loading of memmapped structures for the subsequent calls.
+    repeatedly on the same dataset, it is recommended to pass a cache_dir
+    to store a memmapped backup of the CSR results of the first call and
+    benefit from the near instantaneous loading of memmapped structures
+    for the subsequent calls.
 
     Parameters
     ----------
@@ -45,6 +52,23 @@ def load_svmlight_file(file_path, n_features=None, dtype=None,
         every feature, hence the inferred shape might vary from one
         slice to another.
 
+    use_io_uring: boolean, optional
+        Read the file with io_uring and O_DIRECT instead of mapping it into
+        memory. This is faster for very large files that are not in the
+        page cache. Only available on Linux 5.6 and later; elsewhere the
+        file is read as usual.
+
+    cache_dir: str or None
+        Directory in which to cache the parsed arrays. The cache entry is
+        keyed by the file's absolute path, modification time and size, so
+        it is invalidated when the file changes. Cached arrays are memory
+        mapped copy-on-write: they are read lazily and modifying X doesn't
+        affect the cache.
+
+    n_threads: int or None
+        Maximum number of threads to parse the file with. If None, as many
+        as OpenMP uses by default, e.g., as set by OMP_NUM_THREADS.
+
     Returns
     -------
     (X, y)
@@ -52,32 +76,99 @@ def load_svmlight_file(file_path, n_features=None, dtype=None,
     where X is a scipy.sparse matrix of shape (n_samples, n_features),
           y is a ndarray of shape (n_samples,).
     """
-    data, indices, indptr, labels = _load_svmlight_file(file_path, buffer_mb)
-
-    if zero_based is False or \
-       (zero_based == "auto" and np.min(indices) > 0):
-       indices -= 1
-
-    if n_features is not None:
-        shape = (indptr.shape[0] - 1, n_features)
+    if cache_dir is not None:
+        data, indices, indptr, labels, n_inferred = \
+            _load_cached(cache_dir, file_path, dtype, buffer_mb, zero_based,
+                         use_io_uring, n_threads)
     else:
-        shape = None    # inferred
+        data, indices, indptr, labels, n_inferred = \
+            _parse(file_path, dtype, buffer_mb, zero_based, use_io_uring,
+                   n_threads)
 
-    if dtype:
-        data = np.array(data, dtype=dtype)
+    # Always pass the shape; otherwise scipy scans indices to infer it.
+    if n_features is None:
+        n_features = n_inferred
+    shape = (indptr.shape[0] - 1, n_features)
 
     X_train = sp.csr_matrix((data, indices, indptr), shape)
 
     return (X_train, labels)
 
 
-def load_svmlight_files(files, n_features=None, dtype=None, buffer_mb=40):
+def _parse(file_path, dtype, buffer_mb, zero_based, use_io_uring, n_threads):
+    """Parse file_path; return data, indices, indptr, labels, n_features"""
+    # The extension shifts one-based indices in place; -1 means "auto".
+    if zero_based == "auto":
+        zero_based = -1
+    # float32 data is parsed directly in single precision.
+    single_precision = dtype is not None and np.dtype(dtype) == np.float32
+    data, indices, indptr, labels, n_features = \
+        _load_svmlight_file(file_path, buffer_mb, int(zero_based),
+                            int(single_precision), int(use_io_uring),
+                            n_threads or 0)
+
+    if dtype is not None and data.dtype != dtype:
+        data = data.astype(dtype)
+
+    return data, indices, indptr, labels, n_features
+
+
+_CACHED_ARRAYS = ("data", "indices", "indptr", "labels", "n_features")
+
+
+def _load_cached(cache_dir, file_path, dtype, buffer_mb, zero_based,
+                 use_io_uring, n_threads):
+    """Like _parse, but going through a cache of .npy files in cache_dir"""
+    st = os.stat(file_path)
+    if not stat.S_ISREG(st.st_mode):
+        return _parse(file_path, dtype, buffer_mb, zero_based, use_io_uring,
+                      n_threads)
+
+    key = "%s|%d|%d|%s|%s" % (os.path.abspath(file_path), st.st_mtime_ns,
+                              st.st_size, zero_based,
+                              None if dtype is None else np.dtype(dtype).str)
+    entry = os.path.join(cache_dir,
+                         hashlib.blake2b(key.encode("utf-8")).hexdigest())
+
+    # .npz archives can't be memory mapped, hence one .npy file per array.
+    if os.path.isdir(entry):
+        data, indices, indptr, labels, n_features = [
+            np.load(os.path.join(entry, name + ".npy"), mmap_mode="c")
+            for name in _CACHED_ARRAYS]
+        # y is returned as is, so make it a plain ndarray as on a miss.
+        return (data, indices, indptr, labels.view(np.ndarray),
+                int(n_features))
+
+    parsed = _parse(file_path, dtype, buffer_mb, zero_based, use_io_uring,
+                    n_threads)
+
+    # Write to a temporary directory, then rename it into place, so that
+    # concurrent loaders never see a partial entry.
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp")
+    try:
+        for name, arr in zip(_CACHED_ARRAYS, parsed):
+            np.save(os.path.join(tmp, name + ".npy"), arr)
+        os.rename(tmp, entry)
+    except OSError:
+        # Someone else created the entry first.
+        if not os.path.isdir(entry):
+            raise
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+
+    return parsed
+
+
+def load_svmlight_files(files, n_features=None, dtype=None, buffer_mb=40,
+                        cache_dir=None):
     """Load dataset from multiple files in SVMlight format
 
     This function is equivalent to mapping load_svmlight_file over a list of
     files, except that the results are concatenated into a single, flat list
     and the samples vectors are constrained to all have the same number of
-    features.
+    features. The files after the first are loaded concurrently.
 
     Parameters
     ----------
@@ -91,6 +182,9 @@ def load_svmlight_files(files, n_features=None, dtype=None, buffer_mb=40):
         examples of every feature, hence the inferred shape might vary from
         one slice to another.
 
+    cache_dir: str or None
+        Directory in which to cache the parsed arrays; see load_svmlight_file.
+
     Returns
     -------
     [X1, y1, ..., Xn, yn]
@@ -108,12 +202,29 @@ def load_svmlight_files(files, n_features=None, dtype=None, buffer_mb=40):
     --------
     load_svmlight_file
     """
-    files = iter(files)
-    result = list(load_svmlight_file(files.next(), n_features, dtype, buffer_mb))
+    files = list(files)
+    if not files:
+        return []
+
+    # The first file determines n_features for the others.
+    result = list(load_svmlight_file(files[0], n_features, dtype, buffer_mb,
+                                     cache_dir=cache_dir))
     n_features = result[0].shape[1]
 
-    for f in files:
-        result += load_svmlight_file(f, n_features, dtype, buffer_mb)
+    # The parser releases the GIL, so threads parse the others in parallel.
+    # Each call is itself multithreaded; split the cores between them rather
+    # than starting a full team of threads per file.
+    if len(files) > 1:
+        n_cpus = os.cpu_count() or 1
+        n_workers = min(len(files) - 1, n_cpus)
+        n_threads = max(1, n_cpus // n_workers)
+        with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+            futures = [executor.submit(load_svmlight_file, f, n_features,
+                                       dtype, buffer_mb, cache_dir=cache_dir,
+                                       n_threads=n_threads)
+                       for f in files[1:]]
+            for future in futures:
+                result += future.result()
 
     return result
 
@@ -150,7 +261,17 @@ def dump_svmlight_file(X, y, f, zero_based=True):
         raise ValueError("X.shape[0] and y.shape[0] should be the same, "
                          "got: %r and %r instead." % (X.shape[0], y.shape[0]))
 
-    X = sp.csr_matrix(X, dtype=np.float64)
-    y = np.array(y, dtype=np.float64)
+    # float32 data is written as is, in its shortest single precision form.
+    # A CSR matrix of either type is used as is, rather than copied.
+    dtype = np.float32 if X.dtype == np.float32 else np.float64
+    if not (sp.isspmatrix_csr(X) and X.dtype == dtype):
+        X = sp.csr_matrix(X, dtype=dtype)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+
+    # The extension walks these as flat C arrays. scipy may use int64 index
+    # arrays, so make sure they are contiguous int32.
+    indices = np.ascontiguousarray(X.indices, dtype=np.intc)
+    indptr = np.ascontiguousarray(X.indptr, dtype=np.intc)
 
-    _dump_svmlight_file(f, X.data, X.indices, X.indptr, y, int(zero_based))
+    _dump_svmlight_file(f, np.ascontiguousarray(X.data), indices, indptr, y,
+                        int(zero_based))
@@ -1,18 +1,34 @@
 import numpy as np
+import scipy.sparse as sp
 import os
+import shutil
+import tempfile
+import threading
 
-from numpy.testing import assert_equal, assert_array_equal
+from numpy.testing import assert_equal, assert_array_equal, assert_raises
+from nose import SkipTest
 from nose.tools import raises
 
 from svmlight_loader import (load_svmlight_file, load_svmlight_files,
                              dump_svmlight_file)
 from sklearn.datasets import load_svmlight_file as sk_load_svmlight_file
+from sklearn.datasets import dump_svmlight_file as sk_dump_svmlight_file
 
 currdir = os.path.dirname(os.path.abspath(__file__))
 datafile = os.path.join(currdir, "data", "svmlight_classification.txt")
 invalidfile = os.path.join(currdir, "data", "svmlight_invalid.txt")
 
 
+def _load_string(contents, **kwargs):
+    f, path = tempfile.mkstemp()
+    try:
+        os.write(f, contents.encode())
+        os.close(f)
+        return load_svmlight_file(path, **kwargs)
+    finally:
+        os.remove(path)
+
+
 def test_load_svmlight_file():
     X, y = load_svmlight_file(datafile)
 
@@ -44,6 +60,150 @@ def test_load_svmlight_file():
     assert_array_equal(y, [1, 2, 3])
 
 
+def test_load_zero_based():
+    X, y = load_svmlight_file(datafile, zero_based=True)
+    assert_equal(X.shape[1], 21)
+    assert_equal(X[0, 2], 2.5)
+    assert_equal(X[2, 20], 27)
+
+    X, y = load_svmlight_file(datafile, zero_based=False)
+    assert_equal(X.shape[1], 20)
+    assert_equal(X[0, 1], 2.5)
+
+
+def test_load_multithreaded():
+    # Large enough to be split into several ranges, each parsed by a
+    # thread of its own; the qid fields make the nonzero counts overshoot,
+    # so the ranges have to be compacted too.
+    rng = np.random.RandomState(0)
+    X = sp.random(30000, 1000, density=0.02, format="csr", random_state=rng)
+    X.data = np.round(rng.randn(X.nnz), 4)
+    y = rng.randint(-1, 3, X.shape[0])
+    qid = rng.randint(0, 100, X.shape[0])
+    f, path = tempfile.mkstemp()
+    os.close(f)
+    try:
+        sk_dump_svmlight_file(X, y, path, query_id=qid, comment="1:2 3:4")
+        assert os.path.getsize(path) > 4 << 20
+        X_sk, y_sk = sk_load_svmlight_file(path, n_features=X.shape[1])
+        X2, y2 = load_svmlight_file(path, n_features=X.shape[1], n_threads=4)
+    finally:
+        os.remove(path)
+    assert_array_equal(X2.indptr, X_sk.indptr)
+    assert_array_equal(X2.indices, X_sk.indices)
+    assert_array_equal(X2.data, X_sk.data)
+    assert_array_equal(y2, y_sk)
+
+
+def test_load_long_indices():
+    # Indices of every length from 1 to 10 digits, with and without leading
+    # zeros, at the end of the line and not.
+    indices = [10 ** k - 1 for k in range(1, 10)] + [2 ** 31 - 1]
+    lines = ["1 %d:1 7:2" % i for i in indices]
+    lines += ["2 0000%d:3" % i for i in indices[:7]]
+    X, y = _load_string("\n".join(lines), zero_based=True)
+    assert_equal(X.shape, (17, 2 ** 31))
+    assert_array_equal(X.indices[:20:2], indices)
+    assert_array_equal(X.indices[20:], indices[:7])
+
+
+def test_load_float32():
+    X, y = load_svmlight_file(datafile, dtype=np.float32)
+    assert_equal(X.dtype, np.float32)
+    assert_equal(X[0, 9], np.float32(-5.2))
+    assert_equal(y.dtype, np.float64)
+
+
+def test_load_io_uring():
+    X, y = load_svmlight_file(datafile)
+    X2, y2 = load_svmlight_file(datafile, use_io_uring=True)
+    assert_array_equal(X.toarray(), X2.toarray())
+    assert_array_equal(y, y2)
+
+
+def test_load_io_uring_chunks():
+    # Many more chunks than are read ahead, with lines crossing chunk
+    # boundaries and one line longer than a chunk.
+    rng = np.random.RandomState(0)
+    X = sp.random(2000, 1000, density=0.01, format="csr", random_state=rng)
+    X.data = np.round(rng.randn(X.nnz), 3)
+    y = rng.randint(-1, 3, X.shape[0])
+    f, path = tempfile.mkstemp()
+    os.close(f)
+    try:
+        sk_dump_svmlight_file(X, y, path)
+        with open(path, "rb") as src:
+            block = src.read()
+        long_line = b"1 " + b" ".join(b"%d:1" % i
+                                      for i in range(1, 300000)) + b"\n"
+        with open(path, "wb") as dst:
+            for i in range(20 * (1 << 20) // len(block)):
+                dst.write(block)
+                if i == 10:
+                    dst.write(long_line)
+        X1, y1 = load_svmlight_file(path)
+        X2, y2 = load_svmlight_file(path, use_io_uring=True, buffer_mb=1)
+    finally:
+        os.remove(path)
+    assert_array_equal(X2.indptr, X1.indptr)
+    assert_array_equal(X2.indices, X1.indices)
+    assert_array_equal(X2.data, X1.data)
+    assert_array_equal(y2, y1)
+
+
+def test_load_fifo():
+    # Anything that isn't a regular file is read in chunks through stdio.
+    if not hasattr(os, "mkfifo"):
+        raise SkipTest("os.mkfifo is not available")
+    X, y = load_svmlight_file(datafile)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fifo = os.path.join(tmpdir, "fifo")
+        os.mkfifo(fifo)
+        for use_io_uring in (False, True):
+            def write():
+                with open(datafile, "rb") as src, open(fifo, "wb") as dst:
+                    dst.write(src.read())
+            writer = threading.Thread(target=write)
+            writer.daemon = True
+            writer.start()
+            X2, y2 = load_svmlight_file(fifo, use_io_uring=use_io_uring)
+            writer.join()
+            assert_array_equal(X.toarray(), X2.toarray())
+            assert_array_equal(y, y2)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_load_cache_dir():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        X, y = load_svmlight_file(datafile)
+        for i in range(2):
+            X2, y2 = load_svmlight_file(datafile, cache_dir=cache_dir)
+            assert_array_equal(X.toarray(), X2.toarray())
+            assert_array_equal(y, y2)
+            assert_equal(type(y2), np.ndarray)
+            assert_equal(X2.shape, (3, 20))
+            assert_equal(len(os.listdir(cache_dir)), 1)
+
+        # cached arrays are copy-on-write
+        X2[0, 1] *= 2
+        X3, _ = load_svmlight_file(datafile, cache_dir=cache_dir)
+        assert_equal(X3[0, 1], 2.5)
+
+        # dtype and zero_based have cache entries of their own
+        X4, _ = load_svmlight_file(datafile, dtype=np.float32,
+                                   cache_dir=cache_dir)
+        assert_equal(X4.dtype, np.float32)
+        X5, _ = load_svmlight_file(datafile, zero_based=True,
+                                   cache_dir=cache_dir)
+        assert_equal(X5.shape, (3, 21))
+        assert_equal(len(os.listdir(cache_dir)), 3)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
 def test_load_svmlight_files():
     X_train, y_train, X_test, y_test = load_svmlight_files([datafile] * 2,
                                                            dtype=np.float32)
@@ -74,6 +234,29 @@ def test_load_svmlight_file_n_features():
         assert_equal(X[i, j], val)
 
 
+def test_load_qid():
+    # query_id is not supported, but doesn't stop the file from loading.
+    X, y = _load_string("1 qid:3 1:2.5 3:1\n2 qid:4 2:-1\n")
+    assert_array_equal(X.toarray(), [[2.5, 0, 1], [0, -1, 0]])
+    assert_array_equal(y, [1, 2])
+
+
+def test_load_crlf_and_comments():
+    X, y = _load_string("# header 1:1\r\n"
+                        "1 1:2.5 3:1 # trailing 4:7\r\n"
+                        "2 2:-1\r\n"
+                        "3 #only a comment\r\n")
+    assert_array_equal(X.toarray(), [[2.5, 0, 1], [0, -1, 0], [0, 0, 0]])
+    assert_array_equal(y, [1, 2, 3])
+
+
+def test_load_malformed_features():
+    # These used to end the row silently; now they are errors.
+    for line in ["1 2:x\n", "1 :3\n", "1 2 3\n", "1 -2:3\n", "1 2:3x\n",
+                 "1 2:\n", "1 2:3 4\n", "x 2:3\n"]:
+        assert_raises(ValueError, _load_string, line)
+
+
 @raises(ValueError)
 def test_load_invalid_file():
     load_svmlight_file(invalidfile)
@@ -105,3 +288,40 @@ def test_dump():
     finally:
         os.remove(tmpfile)
 
+
+def test_dump_error():
+    Xs, y = load_svmlight_file(datafile)
+    path = os.path.join(currdir, "no such dir", "dump.txt")
+    try:
+        dump_svmlight_file(Xs, y, path)
+    except IOError as e:
+        assert "No such file or directory" in str(e), str(e)
+    else:
+        raise AssertionError("IOError not raised")
+
+
+def test_dump_float32():
+    try:
+        Xs, y = load_svmlight_file(datafile, dtype=np.float32)
+        tmpfile = "tmp_dump.txt"
+        dump_svmlight_file(Xs, y, tmpfile, zero_based=False)
+        with open(tmpfile) as f:
+            assert "10:-5.2 " in f.read()
+        X2, y2 = load_svmlight_file(tmpfile, dtype=np.float32)
+        assert_array_equal(Xs.toarray(), X2.toarray())
+        assert_array_equal(y, y2)
+    finally:
+        os.remove(tmpfile)
+
+
+def test_dump_int64_indices():
+    try:
+        Xs, y = load_svmlight_file(datafile)
+        Xs.indices = Xs.indices.astype(np.int64)
+        Xs.indptr = Xs.indptr.astype(np.int64)
+        tmpfile = "tmp_dump.txt"
+        dump_svmlight_file(Xs, y, tmpfile)
+        X2, y2 = load_svmlight_file(tmpfile, zero_based=True)
+        assert_array_equal(Xs.toarray(), X2.toarray())
+    finally:
+        os.remove(tmpfile)